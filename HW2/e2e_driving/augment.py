@@ -3,61 +3,148 @@
 # COiLTRAiNE itself is under MIT License                                                              #
 #######################################################################################################
 
+# The imgaug pipelines were ported to albumentations, the ops without a direct albumentations
+# counterpart (Dropout, CoarseDropout, LinearContrast, Grayscale, iaa.Sometimes in random order) are
+# reimplemented below.
+
+import random
 
-import imgaug as ia
-from imgaug import augmenters as iaa
+import cv2
+import numpy as np
+import albumentations as A
 
 
-def hard(image_iteration):
+class Dropout(A.ImageOnlyTransform):
+    """Set a fraction of the pixels to zero, like iaa.Dropout, or iaa.CoarseDropout when size_percent is given.
 
-    iteration = image_iteration/32
-    frequency_factor = min(0.05 + float(iteration)/200000.0, 1.0)
-    color_factor = min(float(iteration)/1000000.0, 1.0)
-    dropout_factor = 0.198667 + (0.03856658 - 0.198667) / (1 + (iteration / 196416.6) ** 1.863486)
+    Args:
+        drop ((float, float)): range the fraction of dropped pixels is sampled from.
+        size_percent ((float, float) or None): range of the relative size of the grid the mask is sampled on.
+        per_channel (float): probability to sample the mask independently for each channel.
+        p (float): probability of applying the transform.
+    """
 
-    blur_factor = min(0.5 + (0.5*iteration/100000.0), 1.0)
+    def __init__(self, drop=(0.0, 0.05), size_percent=None, per_channel=0.0, always_apply=False, p=0.5):
+        super(Dropout, self).__init__(always_apply, p)
+        self.drop = drop
+        self.size_percent = size_percent
+        self.per_channel = per_channel
 
-    add_factor = 10 + 10*iteration/100000.0
+    def apply(self, img, drop=0.0, size_percent=None, per_channel=False, seed=0, **params):
+        h, w = img.shape[:2]
+        c = img.shape[2] if per_channel and img.ndim == 3 else 1
+        random_state = np.random.RandomState(seed)
+        if size_percent is None:
+            keep = random_state.random_sample((h, w, c)) >= drop
+        else:
+            # sample the mask on a coarse grid and upscale it (nearest) to the image size
+            gh, gw = max(1, int(h * size_percent)), max(1, int(w * size_percent))
+            keep = random_state.random_sample((gh, gw, c)) >= drop
+            keep = keep[np.arange(h) * gh // h][:, np.arange(w) * gw // w]
+        if img.ndim == 2:
+            keep = keep[..., 0]
+        return img * keep
 
-    multiply_factor_pos = 1 + (2.5*iteration/200000.0)
-    multiply_factor_neg = 1 - (0.91 * iteration / 500000.0)
+    def get_params(self):
+        return {
+            "drop": random.uniform(*self.drop),
+            "size_percent": random.uniform(*self.size_percent) if self.size_percent is not None else None,
+            "per_channel": random.random() < self.per_channel,
+            "seed": random.randint(0, 2 ** 32 - 1),
+        }
 
-    contrast_factor_pos = 1 + (0.5*iteration/500000.0)
-    contrast_factor_neg = 1 - (0.5 * iteration / 500000.0)
+    def get_transform_init_args_names(self):
+        return ("drop", "size_percent", "per_channel")
 
-    augmenter = iaa.Sequential([
 
-        iaa.Sometimes(frequency_factor, iaa.GaussianBlur((0, blur_factor))),
-        # blur images with a sigma between 0 and 1.5
-        iaa.Sometimes(frequency_factor, iaa.AdditiveGaussianNoise(loc=0, scale=(0.0, dropout_factor),
-                                                                  per_channel=color_factor)),
-        # add gaussian noise to images
-        iaa.Sometimes(frequency_factor, iaa.CoarseDropout((0.0, dropout_factor), size_percent=(
-            0.08, 0.2), per_channel=color_factor)),
-        # randomly remove up to X% of the pixels
-        iaa.Sometimes(frequency_factor, iaa.Dropout((0.0, dropout_factor), per_channel=color_factor)),
-        # randomly remove up to X% of the pixels
-        iaa.Sometimes(frequency_factor,
-                      iaa.Add((-add_factor, add_factor), per_channel=color_factor)),
-        # change brightness of images (by -X to Y of original value)
-        iaa.Sometimes(frequency_factor,
-                      iaa.Multiply((multiply_factor_neg, multiply_factor_pos), per_channel=color_factor)),
-        # change brightness of images (X-Y% of original value)
-        # iaa.Sometimes(frequency_factor, iaa.ContrastNormalization((contrast_factor_neg, contrast_factor_pos),
-        #                                                                per_channel=color_factor)),
-        iaa.Sometimes(frequency_factor, iaa.contrast.LinearContrast((contrast_factor_neg, contrast_factor_pos),
-                                                                    per_channel=color_factor)),
-        # improve or worsen the contrast
-        iaa.Sometimes(frequency_factor, iaa.Grayscale((0.0, 1))),  # put grayscale
+class LinearContrast(A.ImageOnlyTransform):
+    """Scale the distance of every pixel to 128 by a random alpha, like iaa.LinearContrast on uint8 images.
 
-    ],
-        random_order=True  # do all of the above in random order
-    )
+    Args:
+        alpha ((float, float)): range alpha is sampled from.
+        per_channel (float): probability to sample alpha independently for each channel.
+        p (float): probability of applying the transform.
+    """
 
-    return augmenter
+    def __init__(self, alpha=(0.6, 1.4), per_channel=0.0, always_apply=False, p=0.5):
+        super(LinearContrast, self).__init__(always_apply, p)
+        self.alpha = alpha
+        self.per_channel = per_channel
 
+    def apply(self, img, alpha=np.array([1.0]), **params):
+        return np.clip(128 + alpha * (img.astype(np.float32) - 128), 0, 255).astype(img.dtype)
 
-def hard_1(image_iteration):
+    def get_params_dependent_on_targets(self, params):
+        img = params["image"]
+        c = img.shape[2] if img.ndim == 3 and random.random() < self.per_channel else 1
+        return {"alpha": np.array([random.uniform(*self.alpha) for _ in range(c)], dtype=np.float32)}
+
+    @property
+    def targets_as_params(self):
+        return ["image"]
+
+    def get_transform_init_args_names(self):
+        return ("alpha", "per_channel")
+
+
+class Grayscale(A.ImageOnlyTransform):
+    """Blend an RGB image with its grayscale version, like iaa.Grayscale.
+
+    Args:
+        alpha ((float, float)): range the weight of the grayscale image is sampled from.
+        p (float): probability of applying the transform.
+    """
+
+    def __init__(self, alpha=(0.0, 1.0), always_apply=False, p=0.5):
+        super(Grayscale, self).__init__(always_apply, p)
+        self.alpha = alpha
+
+    def apply(self, img, alpha=1.0, **params):
+        return cv2.addWeighted(A.to_gray(img), alpha, img, 1.0 - alpha, 0)
+
+    def get_params(self):
+        return {"alpha": random.uniform(*self.alpha)}
+
+    def get_transform_init_args_names(self):
+        return ("alpha",)
+
+
+class GaussNoise(A.GaussNoise):
+    """A.GaussNoise that rounds instead of truncating when casting back to uint8, like iaa.AdditiveGaussianNoise.
+
+    With the small sigmas used below truncation would shift every pixel down by 0.5 on average.
+    """
+
+    def apply(self, img, gauss=None, **params):
+        noisy = img.astype(np.float32) + gauss
+        if img.dtype == np.uint8:
+            return np.clip(np.round(noisy), 0, 255).astype(np.uint8)
+        return noisy
+
+
+class RandomOrder(A.BaseCompose):
+    """Apply the transforms in a random order, each one with its own probability, like iaa.Sequential(random_order=True).
+
+    Unlike A.SomeOf the children are not forced, so a child with p=0.05 fires on ~5% of the images.
+
+    Args:
+        transforms (list): list of transformations to compose.
+        p (float): probability of applying the whole sequence.
+    """
+
+    def __init__(self, transforms, p=1.0):
+        super(RandomOrder, self).__init__(transforms, p)
+
+    def __call__(self, force_apply=False, **data):
+        if force_apply or random.random() < self.p:
+            transforms = list(self.transforms.transforms)
+            random.shuffle(transforms)
+            for t in transforms:
+                data = t(**data)
+        return data
+
+
+def _hard(image_iteration, size_percent):
 
     iteration = image_iteration/32
     frequency_factor = min(0.05 + float(iteration)/200000.0, 1.0)
@@ -74,33 +161,45 @@ def hard_1(image_iteration):
     contrast_factor_pos = 1 + (0.5*iteration/500000.0)
     contrast_factor_neg = 1 - (0.5 * iteration / 500000.0)
 
-    augmenter = iaa.Sequential([
+    def per_channel(transform, **kwargs):
+        # albumentations only takes a bool, pick the per-channel variant with probability color_factor as imgaug does
+        return A.OneOf([
+            transform(per_channel=True, p=color_factor, **kwargs),
+            transform(per_channel=False, p=1.0 - color_factor, **kwargs),
+        ], p=frequency_factor)
+
+    transforms = [
 
-        iaa.Sometimes(frequency_factor, iaa.GaussianBlur((0, blur_factor))),
+        A.GaussianBlur(blur_limit=0, sigma_limit=(1e-3, blur_factor), p=frequency_factor),
         # blur images with a sigma between 0 and 1.5
-        iaa.Sometimes(frequency_factor, iaa.AdditiveGaussianNoise(loc=0, scale=(0.0, dropout_factor),
-                                                                  per_channel=color_factor)),
+        per_channel(GaussNoise, var_limit=(0.0, dropout_factor ** 2), mean=0),
         # add gaussian noise to images
-        iaa.Sometimes(frequency_factor, iaa.CoarseDropout((0.0, dropout_factor), size_percent=(
-            0.02, 0.2), per_channel=color_factor)),
+        Dropout((0.0, dropout_factor), size_percent=size_percent, per_channel=color_factor, p=frequency_factor),
         # randomly remove up to X% of the pixels
-        iaa.Sometimes(frequency_factor, iaa.Dropout((0.0, dropout_factor), per_channel=color_factor)),
+        Dropout((0.0, dropout_factor), per_channel=color_factor, p=frequency_factor),
         # randomly remove up to X% of the pixels
-        iaa.Sometimes(frequency_factor,
-                      iaa.Add((-add_factor, add_factor), per_channel=color_factor)),
+        A.RandomBrightnessContrast(brightness_limit=add_factor/255.0, contrast_limit=0.0, brightness_by_max=True,
+                                   p=frequency_factor),
         # change brightness of images (by -X to Y of original value)
-        iaa.Sometimes(frequency_factor,
-                      iaa.Multiply((multiply_factor_neg, multiply_factor_pos), per_channel=color_factor)),
+        per_channel(A.MultiplicativeNoise, multiplier=(multiply_factor_neg, multiply_factor_pos)),
         # change brightness of images (X-Y% of original value)
-        # iaa.Sometimes(frequency_factor, iaa.ContrastNormalization((contrast_factor_neg, contrast_factor_pos),
-        #                                                                per_channel=color_factor)),
-        iaa.Sometimes(frequency_factor, iaa.contrast.LinearContrast((contrast_factor_neg, contrast_factor_pos),
-                                                                    per_channel=color_factor)),
+        LinearContrast((contrast_factor_neg, contrast_factor_pos), per_channel=color_factor, p=frequency_factor),
         # improve or worsen the contrast
-        iaa.Sometimes(frequency_factor, iaa.Grayscale((0.0, 1))),  # put grayscale
+        Grayscale((0.0, 1.0), p=frequency_factor),  # put grayscale
+
+    ]
 
-    ],
-        random_order=True  # do all of the above in random order
-    )
+    # do all of the above in random order, each one with its own probability
+    augmenter = A.Compose([
+        RandomOrder(transforms),
+    ])
 
     return augmenter
+
+
+def hard(image_iteration):
+    return _hard(image_iteration, size_percent=(0.08, 0.2))
+
+
+def hard_1(image_iteration):
+    return _hard(image_iteration, size_percent=(0.02, 0.2))
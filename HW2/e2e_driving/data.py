@@ -1,18 +1,51 @@
 import os
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch 
+from torch import nn
 from torch.utils.data import Dataset
-from torchvision import transforms as T
+from torch.utils.data.dataloader import default_collate
+from torchvision.io import read_image, ImageReadMode
 
 from e2e_driving.augment import hard as augmenter
 
+# number of reads between two rebuilds of the augmenter, the hard() factors barely move in between
+AUG_REBUILD_EVERY = 32 * 1000
+
+
+IMAGE_MEAN = [0.485,0.456,0.406]
+IMAGE_STD = [0.229,0.224,0.225]
+
+
+class ImageNormalize(nn.Module):
+	"""
+	ToTensor + Normalize for uint8 CHW (or BCHW) tensors folded into a single pass:
+	(img / 255 - mean) / std == img * scale + shift
+	A module so it can also run on the GPU, the buffers are not saved in checkpoints.
+	"""
+	def __init__(self, mean, std):
+		super().__init__()
+		mean = torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+		std = torch.tensor(std, dtype=torch.float32).view(-1, 1, 1)
+		self.register_buffer('scale', 1. / (255. * std), persistent=False)
+		self.register_buffer('shift', -mean / std, persistent=False)
+
+	def forward(self, img):
+		return torch.addcmul(self.shift, img.to(self.scale.dtype), self.scale)
+
+
 class CARLA_Data(Dataset):
 
-	def __init__(self, root, data_folders, img_aug = False):
+	def __init__(self, root, data_folders, img_aug = False, preload = False, normalize = True):
 		self.root = root
 		self.img_aug = img_aug
 		self._batch_read_number = 0
+		# built lazily inside each worker, see _get_augmenter
+		self._aug = None
+		self._aug_step = -1
+		# set by set_epoch, shared with the workers so they notice a new epoch even when they persist
+		self._epoch = torch.zeros((), dtype=torch.int64).share_memory_()
+		self._aug_epoch = 0
 
 		self.front_img = []
 		self.x = []
@@ -49,31 +82,14 @@ class CARLA_Data(Dataset):
 			self.future_y += data['future_y']
 			self.future_theta += data['future_theta']
 
-		self._im_transform = T.Compose([T.ToTensor(), T.Normalize(mean=[0.485,0.456,0.406], std=[0.229,0.224,0.225])])
-
-	def __len__(self):
-		"""Returns the length of the dataset. """
-		return len(self.front_img)
-
-	def __getitem__(self, index):
-		"""Returns the item at index idx. """
-		data = dict()
-		data['front_img'] = self.front_img[index]
-
-		if self.img_aug:
-			data['front_img'] = self._im_transform(augmenter(self._batch_read_number).augment_image(np.array(
-					Image.open(self.root+self.front_img[index][0]))))
-		else:
-			data['front_img'] = self._im_transform(np.array(
-					Image.open(self.root+self.front_img[index][0])))
+		# full image paths as one fixed-width bytes array: no per-sample string concatenation and no
+		# per-path Python objects whose refcounts get touched (and copied) in forked workers
+		self._paths = np.array([os.fsencode(self.root + img[0]) for img in self.front_img])
 
 		# fix for theta=nan in some measurements
-		if np.isnan(self.theta[index][0]):
-			self.theta[index][0] = 0.
-
-		ego_x = self.x[index][0]
-		ego_y = self.y[index][0]
-		ego_theta = self.theta[index][0]
+		ego_x = np.asarray([x[0] for x in self.x], dtype=np.float64)
+		ego_y = np.asarray([y[0] for y in self.y], dtype=np.float64)
+		ego_theta = np.nan_to_num(np.asarray([theta[0] for theta in self.theta], dtype=np.float64), nan=0.)
 
 		# TODO 1
 		"""
@@ -81,37 +97,24 @@ class CARLA_Data(Dataset):
 		:R: matrix that converts the future (x,y) into ego's coordinate
 		:local_command_point: centering the waypoint around the ego
 		"""
-		waypoints = []
-		for i in range(4):
-			# First, I have to compute the rotation matrix
-			R = np.array([
-				[np.cos(np.pi / 2 + ego_theta), -np.sin(np.pi / 2 + ego_theta)],
-				[np.sin(np.pi / 2 + ego_theta),  np.cos(np.pi / 2 + ego_theta)]
-			]) 
-			# Before multiple the rotation matrix, I have to calculate the relative distance between future waypoints and ego car position
-			local_command_point = np.array([self.future_y[index][i] - ego_y, self.future_x[index][i] - ego_x])
-			local_command_point = R.T.dot(local_command_point)
-			waypoints.append(local_command_point)
-		data['waypoints'] = np.array(waypoints)
+		# every sample's rotation is built here once instead of in __getitem__, shape (N, 2, 2)
+		c, s = np.cos(np.pi / 2 + ego_theta), np.sin(np.pi / 2 + ego_theta)
+		R = np.stack([
+			np.stack([c, -s], axis=-1),
+			np.stack([s,  c], axis=-1)
+		], axis=1)
+		# Before multiple the rotation matrix, I have to calculate the relative distance between future waypoints and ego car position
+		future_x = np.asarray([x[:4] for x in self.future_x], dtype=np.float64)
+		future_y = np.asarray([y[:4] for y in self.future_y], dtype=np.float64)
+		local_command_point = np.stack([future_y - ego_y[:, None], future_x - ego_x[:, None]], axis=-1)
+		# R.T.dot(p) for each of the 4 waypoints of each sample, shape (N, 4, 2)
+		self._waypoints_all = np.einsum('nij,nki->nkj', R, local_command_point).astype(np.float32)
 		# End TODO 1
 
-		R = np.array([
-			[np.cos(np.pi/2+ego_theta), -np.sin(np.pi/2+ego_theta)],
-			[np.sin(np.pi/2+ego_theta),  np.cos(np.pi/2+ego_theta)]
-			])
-		local_command_point = np.array([-1*(self.x_command[index]-ego_x), self.y_command[index]-ego_y] )
-		local_command_point = R.T.dot(local_command_point)
-		data['target_point'] = local_command_point[:2]
-
-
-		local_command_point_aim = np.array([(self.y_command[index]-ego_y), self.x_command[index]-ego_x] )
-		local_command_point_aim = R.T.dot(local_command_point_aim)
-		data['target_point_aim'] = local_command_point_aim[:2]
-
-		data['target_point'] = local_command_point_aim[:2]
-
-		data['speed'] = self.speed[index]
-
+		x_command = np.asarray(self.x_command, dtype=np.float64)
+		y_command = np.asarray(self.y_command, dtype=np.float64)
+		local_command_point_aim = np.stack([y_command - ego_y, x_command - ego_x], axis=-1)
+		self._target_point_all = np.einsum('nij,ni->nj', R, local_command_point_aim).astype(np.float32)
 
 		# TODO 2
 		"""
@@ -126,22 +129,114 @@ class CARLA_Data(Dataset):
 		CHANGELANELEFT = 5
 		CHANGELANERIGHT = 6
 		"""
-		command = self.command[index]
-		if command < 0:
-			command = 4
+		command = np.asarray(self.command, dtype=np.int64)
+		command[command < 0] = 4
 		# Just created the one hot command as required
 		command -= 1
-		assert command in [0, 1, 2, 3, 4, 5]
-		cmd_one_hot = [0] * 6 
-		cmd_one_hot[command] = 1
-
-		data['target_command'] = torch.tensor(cmd_one_hot)		
+		assert ((command >= 0) & (command <= 5)).all()
+		self._cmd_onehot = torch.nn.functional.one_hot(torch.from_numpy(command), 6)
 		# End TODO 2
 
+		# only the arrays above are read per sample, so the raw lists are dropped; touching their Python
+		# objects in forked workers would copy the pages holding them
+		self.speed = np.asarray(self.speed, dtype=np.float32)
+		del self.front_img, self.x, self.y, self.theta, self.future_x, self.future_y, self.future_theta
+		del self.x_command, self.y_command, self.command, self.target_command, self.target_gps, self.only_ap_brake
+
+		# images are decoded straight to uint8 CHW tensors, so only the normalization is left here;
+		# with normalize=False they are returned as uint8 and normalized on the GPU by the caller
+		self._im_transform = ImageNormalize(mean=IMAGE_MEAN, std=IMAGE_STD) if normalize else None
+
+		# optionally decode every frame once, later epochs only pay for augmentation + normalization
+		self._imgs = self._preload_images() if preload else None
+
+	def _preload_images(self):
+		"""
+		Decodes all images into a single uint8 (N, 3, H, W) tensor.
+		Only meant for single-GPU runs, every DDP process would hold its own copy.
+		"""
+		first = read_image(os.fsdecode(self._paths[0]), ImageReadMode.RGB)
+		required = len(self._paths) * first.numel()
+		try:
+			available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+		except (ValueError, OSError, AttributeError):
+			# SC_AVPHYS_PAGES is Linux only, skip the check elsewhere
+			available = None
+		print('Preloading %d images (%.1f GB)' % (len(self._paths), required / 2**30))
+		if available is not None and required > available:
+			print('Warning: preloading needs %.1f GB but only %.1f GB of RAM is free'
+				% (required / 2**30, available / 2**30))
+
+		imgs = torch.empty((len(self._paths),) + tuple(first.shape), dtype=torch.uint8)
+		def load(index):
+			imgs[index].copy_(read_image(os.fsdecode(self._paths[index]), ImageReadMode.RGB))
+		# the decoder runs outside of the GIL, so threads are enough here
+		with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+			list(executor.map(load, range(len(self._paths))))
+		return imgs
+
+	def set_epoch(self, epoch):
+		"""
+		Restarts the curriculum of hard() for the next epoch, the workers pick it up with their next read.
+		"""
+		self._epoch.fill_(epoch)
+
+	def _get_augmenter(self):
+		"""
+		Returns the cached augmenter, rebuilt only when the curriculum of hard() reaches its next step.
+		"""
+		epoch = int(self._epoch)
+		if epoch != self._aug_epoch:
+			# the counter is per worker copy of the dataset, re-forked workers started every epoch at 0
+			self._batch_read_number = 0
+			self._aug_epoch = epoch
+		step = self._batch_read_number // AUG_REBUILD_EVERY
+		if step != self._aug_step:
+			# albumentations draws from random/np.random, which the DataLoader seeds per worker
+			self._aug = augmenter(step * AUG_REBUILD_EVERY)
+			self._aug_step = step
+		return self._aug
+
+	def __len__(self):
+		"""Returns the length of the dataset. """
+		return len(self._paths)
+
+	def __getitem__(self, index):
+		"""Returns the item at index idx. """
+		data = dict()
+		if self._imgs is not None:
+			front_img = self._imgs[index]
+		else:
+			front_img = read_image(os.fsdecode(self._paths[index]), ImageReadMode.RGB)
+		if self.img_aug:
+			front_img = torch.from_numpy(self._get_augmenter()(
+					image=np.ascontiguousarray(front_img.permute(1, 2, 0).numpy()))['image']).permute(2, 0, 1)
+		data['front_img'] = self._im_transform(front_img) if self._im_transform is not None else front_img
+
+		data['waypoints'] = torch.from_numpy(self._waypoints_all[index])
+		data['target_point'] = torch.from_numpy(self._target_point_all[index])
+
+		data['speed'] = self.speed[index]
+
+
+		data['target_command'] = self._cmd_onehot[index]
+
 		self._batch_read_number += 1
 		return data
 
 
+def collate_state(batch):
+	"""
+	default_collate plus the (B, 9) [speed / 12, target_point, target_command] state of VA,
+	so it is assembled on the DataLoader workers instead of on the GPU at every step.
+	"""
+	data = default_collate(batch)
+	speed = data.pop('speed').to(torch.float32).view(-1, 1) / 12.
+	command = data.pop('target_command').to(torch.float32)
+	data['state'] = torch.cat([speed, data['target_point'], command], 1)
+	return data
+
+
 def scale_and_crop_image(image, scale=1, crop_w=256, crop_h=256):
 	"""
 	Scale and crop a PIL image
@@ -161,59 +256,67 @@ def transform_2d_points(xyz, r1, t1_x, t1_y, r2, t2_x, t2_y):
 	"""
 	Build a rotation matrix and take the dot product.
 	"""
-	# z value to 1 for rotation
-	xy1 = xyz.copy()
-	xy1[:,2] = 1
-
+	# r1_to_world is [R1 | t1], world_to_r2 is its closed-form inverse [R2.T | -R2.T t2],
+	# so both steps fold into a single 2x2 rotation plus translation
 	c, s = np.cos(r1), np.sin(r1)
-	r1_to_world = np.matrix([[c, s, t1_x], [-s, c, t1_y], [0, 0, 1]])
-
-	# np.dot converts to a matrix, so we explicitly change it back to an array
-	world = np.asarray(r1_to_world @ xy1.T)
+	R1 = np.array([[c, s], [-s, c]])
 
 	c, s = np.cos(r2), np.sin(r2)
-	r2_to_world = np.matrix([[c, s, t2_x], [-s, c, t2_y], [0, 0, 1]])
-	world_to_r2 = np.linalg.inv(r2_to_world)
+	R2_inv = np.array([[c, -s], [s, c]])
+
+	R = R2_inv @ R1
+	t = R2_inv @ np.array([t1_x - t2_x, t1_y - t2_y])
+
+	out = np.empty(xyz.shape)
+	out[:,:2] = xyz[:,:2] @ R.T + t
 
-	out = np.asarray(world_to_r2 @ world).T
-	
 	# reset z-coordinate
 	out[:,2] = xyz[:,2]
 
 	return out
 
 def rot_to_mat(roll, pitch, yaw):
-	roll = np.deg2rad(roll)
-	pitch = np.deg2rad(pitch)
-	yaw = np.deg2rad(yaw)
-
-	yaw_matrix = np.array([
-		[np.cos(yaw), -np.sin(yaw), 0],
-		[np.sin(yaw), np.cos(yaw), 0],
-		[0, 0, 1]
-	])
-	pitch_matrix = np.array([
-		[np.cos(pitch), 0, -np.sin(pitch)],
-		[0, 1, 0],
-		[np.sin(pitch), 0, np.cos(pitch)]
-	])
-	roll_matrix = np.array([
-		[1, 0, 0],
-		[0, np.cos(roll), np.sin(roll)],
-		[0, -np.sin(roll), np.cos(roll)]
-	])
-
-	rotation_matrix = yaw_matrix.dot(pitch_matrix).dot(roll_matrix)
+	"""
+	yaw_matrix.dot(pitch_matrix).dot(roll_matrix) written out entry by entry, with
+	yaw_matrix = [[cy, -sy, 0], [sy, cy, 0], [0, 0, 1]]
+	pitch_matrix = [[cp, 0, -sp], [0, 1, 0], [sp, 0, cp]]
+	roll_matrix = [[1, 0, 0], [0, cr, sr], [0, -sr, cr]]
+	"""
+	cr, sr = np.cos(np.deg2rad(roll)), np.sin(np.deg2rad(roll))
+	cp, sp = np.cos(np.deg2rad(pitch)), np.sin(np.deg2rad(pitch))
+	cy, sy = np.cos(np.deg2rad(yaw)), np.sin(np.deg2rad(yaw))
+
+	rotation_matrix = np.empty((3, 3))
+	rotation_matrix[0, 0] = cy*cp
+	rotation_matrix[0, 1] = cy*sp*sr - sy*cr
+	rotation_matrix[0, 2] = -cy*sp*cr - sy*sr
+	rotation_matrix[1, 0] = sy*cp
+	rotation_matrix[1, 1] = sy*sp*sr + cy*cr
+	rotation_matrix[1, 2] = -sy*sp*cr + cy*sr
+	rotation_matrix[2, 0] = sp
+	rotation_matrix[2, 1] = -cp*sr
+	rotation_matrix[2, 2] = cp*cr
 	return rotation_matrix
 
 
 def vec_global_to_ref(target_vec_in_global, ref_rot_in_global):
-	R = rot_to_mat(ref_rot_in_global['roll'], ref_rot_in_global['pitch'], ref_rot_in_global['yaw'])
-	np_vec_in_global = np.array([[target_vec_in_global[0]],
-								 [target_vec_in_global[1]],
-								 [target_vec_in_global[2]]])
-	np_vec_in_ref = R.T.dot(np_vec_in_global)
-	return np_vec_in_ref[:,0]
+	"""
+	R.T.dot(v) with R = rot_to_mat(roll, pitch, yaw), evaluated without building R.
+	"""
+	cr, sr = np.cos(np.deg2rad(ref_rot_in_global['roll'])), np.sin(np.deg2rad(ref_rot_in_global['roll']))
+	cp, sp = np.cos(np.deg2rad(ref_rot_in_global['pitch'])), np.sin(np.deg2rad(ref_rot_in_global['pitch']))
+	cy, sy = np.cos(np.deg2rad(ref_rot_in_global['yaw'])), np.sin(np.deg2rad(ref_rot_in_global['yaw']))
+	x, y, z = target_vec_in_global[0], target_vec_in_global[1], target_vec_in_global[2]
+
+	# undo yaw, then pitch, then roll
+	u = cy*x + sy*y
+	v = cy*y - sy*x
+	w = sp*u - cp*z
+	return np.array([
+		cp*u + sp*z,
+		sr*w + cr*v,
+		-cr*w + sr*v,
+	])
 
 
 	
\ No newline at end of file
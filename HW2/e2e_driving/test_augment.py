@@ -0,0 +1,51 @@
+import numpy as np
+import albumentations as A
+
+from e2e_driving.augment import hard, GaussNoise
+
+
+def ops(augmenter):
+    # the ops of a hard() augmenter, the per-channel variants of an op are alternatives and grouped together
+    groups = []
+    for t in augmenter.transforms:
+        if isinstance(t, A.BaseCompose) and not isinstance(t, A.OneOf):
+            groups.extend(ops(t))
+        elif isinstance(t, A.OneOf):
+            groups.append([c for group in ops(t) for c in group])
+        else:
+            groups.append([t])
+    return groups
+
+
+def test_hard_firing_rate(monkeypatch):
+    # count how often each op of hard(0) is applied, they should all fire with frequency_factor = 0.05
+    fired = {}
+    apply_with_params = A.BasicTransform.apply_with_params
+
+    def counting(self, params, **kwargs):
+        fired[id(self)] = fired.get(id(self), 0) + 1
+        return apply_with_params(self, params, **kwargs)
+
+    monkeypatch.setattr(A.BasicTransform, "apply_with_params", counting)
+
+    augmenter = hard(0)
+    groups = ops(augmenter)
+    assert groups
+    image = np.full((8, 8, 3), 128, dtype=np.uint8)
+    n = 4000
+    for _ in range(n):
+        augmenter(image=image)
+
+    for group in groups:
+        rate = sum(fired.get(id(t), 0) for t in group) / n
+        assert 0.03 < rate < 0.07, (group, rate)
+
+
+def test_hard_gauss_noise_keeps_brightness():
+    # small noise with a truncating cast darkens the image by ~0.5
+    noises = [t for group in ops(hard(0)) for t in group if isinstance(t, GaussNoise)]
+    assert noises
+    image = np.full((64, 64, 3), 128, dtype=np.uint8)
+    for noise in noises:
+        out = noise.apply(image, gauss=np.random.normal(0.0, 0.2, image.shape).astype(np.float32))
+        assert abs(out.mean() - 128) < 0.1
@@ -1,5 +1,7 @@
 import argparse
 import os
+import sys
+import shutil
 from collections import OrderedDict
 
 import torch
@@ -14,31 +16,61 @@ from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.plugins import DDPPlugin
 
 from e2e_driving.model import VA
-from e2e_driving.data import CARLA_Data
+from e2e_driving.data import CARLA_Data, ImageNormalize, IMAGE_MEAN, IMAGE_STD, collate_state
 from e2e_driving.config import GlobalConfig
 
 
 class VA_planner(pl.LightningModule):
-	def __init__(self, config, lr):
+	def __init__(self, config, lr, compile_model=False):
 		super().__init__()
 		self.lr = lr
 		self.config = config
-		self.model = VA(config)
+		# NHWC lets cuDNN pick its Tensor Core conv kernels under mixed precision
+		self.model = VA(config).to(memory_format=torch.channels_last)
+		# normalizes the uint8 images of datasets built with normalize=False on the GPU
+		self.im_normalize = ImageNormalize(mean=IMAGE_MEAN, std=IMAGE_STD)
+		# traced VA graphs of torch < 2.0, see run_model
+		self._traced = None
+		if compile_model:
+			if hasattr(torch, 'compile'):
+				# only the bound forward is compiled, so the state_dict keys loaded by vision_agent.py stay the same
+				self.model.forward = torch.compile(self.model.forward, mode='reduce-overhead')
+			else:
+				self._traced = {}
 	
 	def forward(self, batch):
 		pass
 
+	def preprocess_image(self, front_img):
+		if front_img.dtype == torch.uint8:
+			front_img = self.im_normalize(front_img)
+		return front_img.to(memory_format=torch.channels_last)
+
+	def run_model(self, front_img, state, target_point):
+		"""
+		Runs the VA model, through torch.jit.trace when --compile is set on torch < 2.0.
+		The trace unrolls the pred_len loop and shares the parameters and buffers of self.model. It is taken
+		on the first batch, after the Trainer moved the model and converted it to SyncBatchNorm, and once
+		per mode since BatchNorm and Dropout bake the train/eval mode into the graph.
+		"""
+		if self._traced is None:
+			return self.model(front_img, state, target_point)
+		key = (self.model.training, torch.is_autocast_enabled())
+		if key not in self._traced:
+			# strict=False allows the dict output
+			self._traced[key] = torch.jit.trace(self.model, (front_img, state, target_point), strict=False, check_trace=False)
+		return self._traced[key](front_img, state, target_point)
+
 	def training_step(self, batch, batch_idx):
-		front_img = batch['front_img']
-		speed = batch['speed'].to(dtype=torch.float32).view(-1,1) / 12.
-		target_point = batch['target_point'].to(dtype=torch.float32)
-		command = batch['target_command']
-		
-		state = torch.cat([speed, target_point, command], 1)
+		front_img = self.preprocess_image(batch['front_img'])
+		# state = [speed / 12, target point, command], assembled by collate_state
+		state = batch['state']
+		speed = state[:, :1]
+		target_point = batch['target_point']
 
 		gt_waypoints = batch['waypoints']
 
-		pred = self.model(front_img, state, target_point)
+		pred = self.run_model(front_img, state, target_point)
 
 		speed_loss = F.l1_loss(pred['pred_speed'], speed) * self.config.speed_weight
 		
@@ -46,8 +78,9 @@ class VA_planner(pl.LightningModule):
 		
 		loss = speed_loss + wp_loss
 		
-		self.log('train_wp_loss_loss', wp_loss.item())
-		self.log('train_speed_loss', speed_loss.item())
+		# log the tensors, Lightning only reads them back from the GPU when it writes a log or refreshes the progress bar
+		self.log('train_wp_loss_loss', wp_loss, on_step=True, on_epoch=False)
+		self.log('train_speed_loss', speed_loss, on_step=True, on_epoch=False)
 
 		return loss
 
@@ -57,15 +90,14 @@ class VA_planner(pl.LightningModule):
 		return [optimizer], [lr_scheduler]
 
 	def validation_step(self, batch, batch_idx):
-		front_img = batch['front_img']
-		speed = batch['speed'].to(dtype=torch.float32).view(-1,1) / 12.
-		target_point = batch['target_point'].to(dtype=torch.float32)
-		command = batch['target_command']
-		state = torch.cat([speed, target_point, command], 1)
+		front_img = self.preprocess_image(batch['front_img'])
+		state = batch['state']
+		speed = state[:, :1]
+		target_point = batch['target_point']
 
 		gt_waypoints = batch['waypoints']
 
-		pred = self.model(front_img, state, target_point)
+		pred = self.run_model(front_img, state, target_point)
 		
 		speed_loss = F.l1_loss(pred['pred_speed'], speed) * self.config.speed_weight
 		
@@ -73,9 +105,47 @@ class VA_planner(pl.LightningModule):
 
 		val_loss = wp_loss + speed_loss
 
-		self.log('val_speed_loss', speed_loss.item(), sync_dist=True)
-		self.log('val_wp_loss_loss', wp_loss.item(), sync_dist=True)
-		self.log('val_loss', val_loss.item(), sync_dist=True)
+		self.log('val_speed_loss', speed_loss, sync_dist=True)
+		self.log('val_wp_loss_loss', wp_loss, sync_dist=True)
+		self.log('val_loss', val_loss, sync_dist=True)
+
+
+class StaticGraphDDPPlugin(DDPPlugin):
+	"""
+	DDPPlugin that also marks the DDP graph as static, the VA graph is identical at every step.
+	torch 1.10 only exposes this as _set_static_graph(), the static_graph argument arrives in 1.11.
+	"""
+	def configure_ddp(self):
+		super().configure_ddp()
+		if hasattr(self._model, '_set_static_graph'):
+			self._model._set_static_graph()
+
+
+class AugmentEpochCallback(pl.Callback):
+	"""
+	Publishes the epoch to the dataset, so the persistent workers restart the img_aug curriculum every epoch.
+	"""
+	def __init__(self, dataset):
+		self.dataset = dataset
+
+	def on_train_epoch_start(self, trainer, pl_module):
+		# runs before the epoch iterates the DataLoader, i.e. before the workers get their first index
+		self.dataset.set_epoch(trainer.current_epoch)
+
+
+def check_shm(batch_size, num_workers, prefetch_factor, sample_bytes=3*256*256*4):
+	"""
+	Worker batches travel through /dev/shm, warn if it cannot hold the prefetched ones.
+	"""
+	if not os.path.isdir('/dev/shm') or num_workers == 0:
+		return
+	# train and val loaders both keep persistent workers
+	required = 2 * num_workers * prefetch_factor * batch_size * sample_bytes
+	free = shutil.disk_usage('/dev/shm').free
+	if free < required:
+		print('Warning: /dev/shm has %.1f MB free but the DataLoaders may need %.1f MB, '
+			'reduce --num_workers (rather than --prefetch_factor) on low-shmem containers.'
+			% (free / 2**20, required / 2**20))
 
 
 if __name__ == "__main__":
@@ -86,8 +156,15 @@ if __name__ == "__main__":
 	parser.add_argument('--lr', type=float, default=0.0001, help='Learning rate.')
 	parser.add_argument('--val_every', type=int, default=3, help='Validation frequency (epochs).')
 	parser.add_argument('--batch_size', type=int, default=32, help='Batch size')
+	parser.add_argument('--accumulate_grad_batches', type=int, default=1, help='Number of batches to accumulate gradients over.')
 	parser.add_argument('--logdir', type=str, default='log', help='Directory to log data to.')
+	parser.add_argument('--log_every_n_steps', type=int, default=1, help='Logging frequency (steps), each log reads the losses back from the GPU.')
+	parser.add_argument('--progress_bar_refresh_rate', type=int, default=1, help='Progress bar refresh frequency (steps), each refresh reads the running loss back from the GPU.')
 	parser.add_argument('--gpus', type=int, default=1, help='number of gpus')
+	parser.add_argument('--precision', type=int, default=16, help='Floating point precision, 16 enables mixed precision.')
+	parser.add_argument('--num_workers', type=int, default=8, help='Number of DataLoader workers.')
+	parser.add_argument('--prefetch_factor', type=int, default=4, help='Batches prefetched by each DataLoader worker.')
+	parser.add_argument('--compile', action='store_true', help='Compile the VA forward with torch.compile (torch >= 2.0) or torch.jit.trace (older torch).')
 
 	args = parser.parse_args()
 	args.logdir = os.path.join(args.logdir, args.id)
@@ -96,15 +173,26 @@ if __name__ == "__main__":
 	config = GlobalConfig()
 
 	# Data
-	train_set = CARLA_Data(root=config.root_dir_all, data_folders=config.train_data, img_aug = config.img_aug)
+	train_set = CARLA_Data(root=config.root_dir_all, data_folders=config.train_data, img_aug = config.img_aug, preload = config.preload,
+							normalize = not config.gpu_normalize)
 	print(len(train_set))
-	val_set = CARLA_Data(root=config.root_dir_all, data_folders=config.val_data,)
+	val_set = CARLA_Data(root=config.root_dir_all, data_folders=config.val_data, preload = config.preload,
+							normalize = not config.gpu_normalize)
 	print(len(val_set))
 
-	dataloader_train = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, num_workers=8)
-	dataloader_val = DataLoader(val_set, batch_size=args.batch_size, shuffle=False, num_workers=8)
+	check_shm(args.batch_size, args.num_workers, args.prefetch_factor, sample_bytes=3*256*256*(1 if config.gpu_normalize else 4))
+	# pinned batches let Lightning's non_blocking device transfer overlap with compute
+	loader_kwargs = dict(num_workers=args.num_workers, pin_memory=True, collate_fn=collate_state)
+	if args.num_workers > 0:
+		# fork lets workers share the already imported modules and dataset arrays, AugmentEpochCallback restarts
+		# the img_aug curriculum of the persistent workers every epoch as re-forked workers did
+		loader_kwargs.update(persistent_workers=True, prefetch_factor=args.prefetch_factor,
+							multiprocessing_context='fork' if sys.platform.startswith('linux') else None)
+	# a fixed batch shape keeps cudnn.benchmark and compiled graphs from re-tuning on the last batch
+	dataloader_train = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=True, **loader_kwargs)
+	dataloader_val = DataLoader(val_set, batch_size=args.batch_size, shuffle=False, **loader_kwargs)
 
-	VA_model = VA_planner(config, args.lr)
+	VA_model = VA_planner(config, args.lr, compile_model=args.compile)
 
 	checkpoint_callback = ModelCheckpoint(save_weights_only=False, mode="min", monitor="val_loss", save_top_k=2, save_last=True,
 											dirpath=args.logdir, filename="best_{epoch:02d}-{val_loss:.3f}")
@@ -114,12 +202,15 @@ if __name__ == "__main__":
 											gpus = args.gpus,
 											accelerator='ddp',
 											sync_batchnorm=True,
-											plugins=DDPPlugin(find_unused_parameters=False),
+											plugins=StaticGraphDDPPlugin(find_unused_parameters=False, gradient_as_bucket_view=True),
 											profiler='simple',
 											benchmark=True,
-											log_every_n_steps=1,
+											precision=args.precision,
+											log_every_n_steps=args.log_every_n_steps,
+											progress_bar_refresh_rate=args.progress_bar_refresh_rate,
 											flush_logs_every_n_steps=5,
 											callbacks=[checkpoint_callback,
+														AugmentEpochCallback(train_set),
 														],
 											check_val_every_n_epoch = args.val_every,
 											max_epochs = args.epochs
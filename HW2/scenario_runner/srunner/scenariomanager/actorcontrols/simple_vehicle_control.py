@@ -234,9 +234,11 @@ class SimpleVehicleControl(BasicControl):
             if self._obstacle_distance < self._proximity_threshold:
                 distance = max(self._obstacle_distance, 0)
                 if distance > 0:
-                    current_speed = math.sqrt(self._actor.get_velocity().x**2 + self._actor.get_velocity().y**2)
-                    current_speed_other = math.sqrt(
-                        self._obstacle_actor.get_velocity().x**2 + self._obstacle_actor.get_velocity().y**2)
+                    # query each velocity once instead of once per component
+                    velocity = self._actor.get_velocity()
+                    current_speed = math.hypot(velocity.x, velocity.y)
+                    velocity_other = self._obstacle_actor.get_velocity()
+                    current_speed_other = math.hypot(velocity_other.x, velocity_other.y)
                     if current_speed_other < current_speed:
                         acceleration = -0.5 * (current_speed - current_speed_other)**2 / distance
                         target_speed = max(acceleration * (current_time - self._last_update) + current_speed, 0)
@@ -246,9 +248,10 @@ class SimpleVehicleControl(BasicControl):
         # set new linear velocity
         velocity = carla.Vector3D(0, 0, 0)
         direction = next_location - CarlaDataProvider.get_location(self._actor)
-        direction_norm = math.sqrt(direction.x**2 + direction.y**2)
-        velocity.x = direction.x / direction_norm * target_speed
-        velocity.y = direction.y / direction_norm * target_speed
+        direction_norm = math.hypot(direction.x, direction.y)
+        speed_per_meter = target_speed / direction_norm
+        velocity.x = direction.x * speed_per_meter
+        velocity.y = direction.y * speed_per_meter
 
         self._actor.set_target_velocity(velocity)
 